@@ -1,8 +1,22 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import pyarrow as pa
+import plotly.graph_objects as go
 from pathlib import Path
 from io import BytesIO
+import os
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from loader import (
+    load_sheets_total,
+    parquet_path,
+    prepare_total,
+    save_parquet,
+    total_sheet_names,
+)
 
 # =====================
 # CONFIGURATION
@@ -31,53 +45,67 @@ FILE_PATH = Path("stress_test.xlsx")
 # =====================
 # LOAD DATA
 # =====================
-@st.cache_data
-def load_excel_total(path: Path) -> pd.DataFrame:
-    if not path.exists():
-        st.error(f"File not found: {path}")
-        st.stop()
-
-    xls = pd.ExcelFile(path)
-    total_rows = []
-
-    for sheet in xls.sheet_names:
-        if "_" not in sheet:
-            continue
-
-        portfolio_sheet, scenario_sheet = sheet.split("_", 1)
-        raw = pd.read_excel(xls, sheet_name=sheet)
-
-        df_total = raw[raw["Risk Group"] == "Total"].copy()
-        if df_total.empty:
-            continue
-
-        df_total = df_total[
-            ["Risk Group", "Stress PnL", "Date", "Portfolio", "Scenario"]
-        ]
-
-        df_total["Portfolio"] = df_total["Portfolio"].fillna(portfolio_sheet)
-        df_total["Scenario"] = df_total["Scenario"].fillna(scenario_sheet)
-
-        total_rows.append(df_total)
-
-    if not total_rows:
-        st.error("No 'Total' rows found in Excel sheets")
-        st.stop()
-
-    return pd.concat(total_rows, ignore_index=True)
-
-df_total = load_excel_total(FILE_PATH)
-
-# =====================
-# DATE PREPARATION
-# =====================
-df_total["Date"] = pd.to_datetime(df_total["Date"]).dt.date
-
-available_dates = sorted(df_total["Date"].unique())
-last_date = max(available_dates)
+def read_workbook_total(path: Path) -> list[pd.DataFrame]:
+    sheets = total_sheet_names(path)
+
+    # Split the sheets into one batch per worker so each thread opens the workbook once.
+    # Threads rather than processes: the sheet parsing runs in calamine's Rust code,
+    # and forking Streamlit's multi-threaded server is not safe
+    n_workers = max(1, min(len(sheets), os.cpu_count() or 1))
+    batch_size = max(1, -(-len(sheets) // n_workers))
+    batches = [sheets[i:i + batch_size] for i in range(0, len(sheets), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(partial(load_sheets_total, path), batches))
+
+# Persisted to disk so restarts skip the load entirely; the mtimes are only there
+# to key the cache, so editing the workbook or rebuilding the snapshot invalidates it
+@st.cache_data(persist="disk")
+def load_excel_total(
+    path: Path, mtime: float, snapshot_mtime: float | None
+) -> tuple[pd.DataFrame, list, list, list]:
+    # Prefer the Parquet snapshot while it is at least as new as the workbook
+    cache_path = parquet_path(path)
+    if cache_path.exists() and cache_path.stat().st_mtime >= mtime:
+        # Typing is a no-op on a snapshot written by this app, and still
+        # fixes up an untyped one
+        df_total = prepare_total(pd.read_parquet(cache_path))
+    else:
+        total_rows = [df for df in read_workbook_total(path) if not df.empty]
+
+        if not total_rows:
+            st.error("No 'Total' rows found in Excel sheets")
+            st.stop()
+
+        df_total = prepare_total(pd.concat(total_rows, ignore_index=True))
+
+        # Write the typed, sorted table as the snapshot for the next cold start.
+        # The snapshot is optional: a read-only deployment or a column Arrow
+        # rejects just keeps parsing the workbook
+        try:
+            save_parquet(df_total, path)
+        except (OSError, pa.ArrowException):
+            pass
+
+    # Sorted filter options, computed once per file instead of on every rerun
+    available_dates = df_total["Date"].dropna().drop_duplicates().dt.date.tolist()
+    all_portfolios = df_total["Portfolio"].cat.categories.tolist()
+    all_scenarios = df_total["Scenario"].cat.categories.tolist()
+
+    return df_total, available_dates, all_portfolios, all_scenarios
+
+if not FILE_PATH.exists():
+    st.error(f"File not found: {FILE_PATH}")
+    st.stop()
+
+snapshot_path = parquet_path(FILE_PATH)
+snapshot_mtime = snapshot_path.stat().st_mtime if snapshot_path.exists() else None
+
+df_total, available_dates, all_portfolios, all_scenarios = load_excel_total(
+    FILE_PATH, FILE_PATH.stat().st_mtime, snapshot_mtime
+)
 
-all_portfolios = sorted(df_total["Portfolio"].unique())
-all_scenarios = sorted(df_total["Scenario"].unique())
+last_date = available_dates[-1]
 
 # =====================
 # SESSION STATE INIT
@@ -112,8 +140,8 @@ st.sidebar.header("🎛️ Filters")
 date_sel = st.sidebar.date_input(
     "📅 Date",
     value=last_date,
-    min_value=min(available_dates),
-    max_value=max(available_dates)
+    min_value=available_dates[0],
+    max_value=available_dates[-1]
 )
 
 st.sidebar.multiselect(
@@ -141,14 +169,124 @@ st.sidebar.checkbox(
 # =====================
 # DATA FILTERING
 # =====================
-df_filt = df_total[
-    (df_total["Date"] == date_sel)
-    & df_total["Portfolio"].isin(st.session_state.portfolio_sel)
-    & df_total["Scenario"].isin(st.session_state.scenario_sel)
-]
+def selection_mask(column: pd.Series, selected: list) -> np.ndarray:
+    # Boolean lookup per category gathered through the codes; the extra
+    # trailing False absorbs the -1 code of missing values
+    lookup = np.zeros(len(column.cat.categories) + 1, dtype=bool)
+    codes = column.cat.categories.get_indexer(selected)
+    lookup[codes[codes >= 0]] = True
+    return lookup[column.cat.codes.to_numpy()]
+
+day_start = df_total["Date"].searchsorted(pd.Timestamp(date_sel), side="left")
+day_end = df_total["Date"].searchsorted(pd.Timestamp(date_sel), side="right")
+df_day = df_total.iloc[day_start:day_end]
+
+mask = np.logical_and(
+    selection_mask(df_day["Portfolio"], st.session_state.portfolio_sel),
+    selection_mask(df_day["Scenario"], st.session_state.scenario_sel),
+)
+df_filt = df_day[mask]
+
+# Portfolios present after filtering, already sorted by the category order
+visible_portfolios = (
+    df_filt["Portfolio"].cat.remove_unused_categories().cat.categories.tolist()
+)
 
 excel_data = {}
 
+# =====================
+# CACHED FIGURES
+# =====================
+# Figures are keyed by the plotted values, so toggling back to an earlier
+# filter combination reuses the figure instead of rebuilding it
+@st.cache_resource(max_entries=64)
+def portfolio_bar_chart(portfolio: str, scenarios: tuple, stress_pnl: tuple) -> go.Figure:
+    return go.Figure(
+        go.Bar(
+            x=scenarios,
+            y=stress_pnl,
+            hovertemplate="Scenario=%{x}<br>Stress PnL=%{y}<extra></extra>"
+        ),
+        layout=dict(
+            title=f"Portfolio {portfolio}",
+            showlegend=False,
+            xaxis_title="Scenario",
+            yaxis_title="Stress PnL (bps)",
+            height=450
+        )
+    )
+
+@st.cache_resource(max_entries=64)
+def peer_analysis_chart(analysis_portfolio: str, df_plot: pd.DataFrame) -> go.Figure:
+    # All q25-q75 bands in a single trace; None breaks the line between scenarios
+    band_x, band_y = [], []
+    for q25, q75, scenario in zip(df_plot["q25"], df_plot["q75"], df_plot["Scenario"]):
+        band_x += [q25, q75, None]
+        band_y += [scenario, scenario, None]
+
+    return go.Figure(
+        data=[
+            go.Scatter(
+                x=df_plot["Stress PnL"],
+                y=df_plot["Scenario"],
+                mode="markers",
+                hovertemplate="Stress PnL=%{x}<br>Scenario=%{y}<extra></extra>",
+                showlegend=False
+            ),
+            go.Scatter(
+                x=band_x,
+                y=band_y,
+                mode="lines",
+                line=dict(width=14, color="rgba(255,0,0,0.25)"),
+                showlegend=False
+            ),
+            go.Scatter(
+                x=df_plot["peer_median"],
+                y=df_plot["Scenario"],
+                mode="markers",
+                marker=dict(size=9, color="red"),
+                name="Peer median"
+            ),
+            go.Scatter(
+                x=df_plot["Stress PnL"],
+                y=df_plot["Scenario"],
+                mode="markers",
+                marker=dict(size=14, symbol="star", color="orange"),
+                name="Analysis portfolio"
+            ),
+        ],
+        layout=dict(
+            title=f"Peer Analysis – {analysis_portfolio}",
+            xaxis_title="Stress PnL",
+            yaxis_title="Scenario"
+        )
+    )
+
+# =====================
+# CACHED EXCEL EXPORTS
+# =====================
+def write_sheet(workbook: xlsxwriter.Workbook, sheet_name: str, df: pd.DataFrame) -> None:
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, df.columns.tolist())
+
+    # constant_memory flushes each row as soon as the next one starts, so rows
+    # must go out in order; missing values become blank cells as with to_excel
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    for i, row in enumerate(rows, start=1):
+        worksheet.write_row(i, 0, row)
+
+def build_xlsx(df: pd.DataFrame, sheet_name: str) -> bytes:
+    return build_multi_xlsx({sheet_name: df})
+
+# Workbooks are only rebuilt when the table content changes, not on every rerun
+@st.cache_data(max_entries=64)
+def build_multi_xlsx(sheets: dict[str, pd.DataFrame]) -> bytes:
+    output = BytesIO()
+    with xlsxwriter.Workbook(output, {"constant_memory": True}) as workbook:
+        for sheet_name, df in sheets.items():
+            write_sheet(workbook, sheet_name, df)
+    return output.getvalue()
+
 # =====================
 # CHART + TABLE BY PORTFOLIO
 # =====================
@@ -157,64 +295,52 @@ if df_filt.empty:
 else:
     st.subheader(f"📅 Date: {date_sel}")
 
-    visible_portfolios = sorted(df_filt["Portfolio"].unique())
-
-    for p in visible_portfolios:
-        df_port = (
-            df_filt[df_filt["Portfolio"] == p]
-            .sort_values("Scenario")
-        )
+    # One sort and one grouping pass instead of re-scanning df_filt per portfolio
+    df_by_portfolio = (
+        df_filt.sort_values(["Portfolio", "Scenario"])
+        .groupby("Portfolio", sort=True, observed=True)
+    )
 
-        fig = px.bar(
-            df_port,
-            x="Scenario",
-            y="Stress PnL",
-            title=f"Portfolio {p}",
-        )
+    for p, df_port in df_by_portfolio:
 
-        fig.update_layout(
-            showlegend=False,
-            xaxis_title="Scenario",
-            yaxis_title="Stress PnL (bps)",
-            height=450
+        fig = portfolio_bar_chart(
+            p, tuple(df_port["Scenario"]), tuple(df_port["Stress PnL"])
         )
 
         st.plotly_chart(fig, use_container_width=True)
 
-        df_display = df_port.rename(
+        # Project before renaming so only the two displayed columns are copied
+        df_display = df_port[["Scenario", "Stress PnL"]].rename(
             columns={
                 "Stress PnL": "Stress PnL bps"
             }
-        )[["Scenario", "Stress PnL bps"]]
+        )
 
         excel_data[p] = df_display
 
-        output_single = BytesIO()
-        with pd.ExcelWriter(output_single, engine="openpyxl") as writer:
-            df_display.to_excel(writer, sheet_name=p[:31], index=False)
-
         st.download_button(
             label="📥 Download table as Excel",
-            data=output_single.getvalue(),
+            data=build_xlsx(df_display, p[:31]),
             file_name=f"stress_pnl_{p}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             key=f"download_{p}"
         )
 
-        st.dataframe(df_display, use_container_width=True, hide_index=True)
+        # Stress PnL is held as float32 but the source is whole basis points
+        st.dataframe(
+            df_display,
+            use_container_width=True,
+            hide_index=True,
+            column_config={"Stress PnL bps": st.column_config.NumberColumn(format="%d")}
+        )
 
 # =====================
 # MULTI-SHEET EXCEL
 # =====================
 if len(excel_data) > 1:
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        for portfolio, df_sheet in excel_data.items():
-            df_sheet.to_excel(writer, sheet_name=portfolio[:31], index=False)
-
     st.download_button(
         label="📥 Download all tables as Excel",
-        data=output.getvalue(),
+        data=build_multi_xlsx({p[:31]: df_sheet for p, df_sheet in excel_data.items()}),
         file_name="stress_pnl_per_portfolio.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
@@ -225,120 +351,104 @@ if len(excel_data) > 1:
 st.markdown("---")
 st.header("⭐ Peer Analysis")
 
-if df_filt["Portfolio"].nunique() < 2:
-    st.info("Peer analysis available only when at least two portfolios are selected.")
-else:
-    col1, col2 = st.columns(2)
-
-    with col1:
-        analysis_portfolio = st.selectbox(
-            "⭐ Analysis portfolio",
-            options=sorted(df_filt["Portfolio"].unique())
-        )
-
-    with col2:
-        peer_portfolios = st.multiselect(
-            "◼ Peer portfolios",
-            options=[p for p in df_filt["Portfolio"].unique() if p != analysis_portfolio],
-            default=[p for p in df_filt["Portfolio"].unique() if p != analysis_portfolio]
-        )
-
-    if peer_portfolios:
-        df_analysis = df_filt[df_filt["Portfolio"] == analysis_portfolio][
-            ["Scenario", "Stress PnL"]
-        ]
+# Runs as a fragment: changing the analysis/peer portfolios only reruns this
+# section, not the charts and workbooks above
+@st.fragment
+def peer_analysis(df_filt: pd.DataFrame, visible_portfolios: list):
+    if len(visible_portfolios) < 2:
+        st.info("Peer analysis available only when at least two portfolios are selected.")
+    else:
+        col1, col2 = st.columns(2)
+
+        with col1:
+            analysis_portfolio = st.selectbox(
+                "⭐ Analysis portfolio",
+                options=visible_portfolios
+            )
 
-        df_peers = df_filt[df_filt["Portfolio"].isin(peer_portfolios)][
-            ["Scenario", "Stress PnL"]
-        ]
+        peer_options = [p for p in visible_portfolios if p != analysis_portfolio]
 
-        df_peer_stats = df_peers.groupby("Scenario", as_index=False).agg(
-            peer_median=("Stress PnL", "median"),
-            q25=("Stress PnL", lambda x: x.quantile(0.25)),
-            q75=("Stress PnL", lambda x: x.quantile(0.75))
-        )
+        with col2:
+            peer_portfolios = st.multiselect(
+                "◼ Peer portfolios",
+                options=peer_options,
+                default=peer_options
+            )
 
-        df_plot = df_analysis.merge(df_peer_stats, on="Scenario")
+        if peer_portfolios:
+            # Row mask and column projection in one .loc call: one allocation each
+            df_analysis = df_filt.loc[
+                df_filt["Portfolio"] == analysis_portfolio, ["Scenario", "Stress PnL"]
+            ]
 
-        fig = px.scatter(
-            df_plot,
-            x="Stress PnL",
-            y="Scenario",
-            title=f"Peer Analysis – {analysis_portfolio}",
-        )
+            df_peers = df_filt.loc[
+                df_filt["Portfolio"].isin(peer_portfolios), ["Scenario", "Stress PnL"]
+            ]
 
-        for _, r in df_plot.iterrows():
-            fig.add_scatter(
-                x=[r["q25"], r["q75"]],
-                y=[r["Scenario"], r["Scenario"]],
-                mode="lines",
-                line=dict(width=14, color="rgba(255,0,0,0.25)"),
-                showlegend=False
+            # All three quantiles in one vectorized groupby pass, no per-group lambdas
+            df_peer_stats = (
+                df_peers.groupby("Scenario", observed=True)["Stress PnL"]
+                .quantile([0.25, 0.5, 0.75])
+                .unstack()
+                .rename(columns={0.25: "q25", 0.5: "peer_median", 0.75: "q75"})
+                .reset_index()
             )
 
-        fig.add_scatter(
-            x=df_plot["peer_median"],
-            y=df_plot["Scenario"],
-            mode="markers",
-            marker=dict(size=9, color="red"),
-            name="Peer median"
-        )
+            df_plot = df_analysis.merge(df_peer_stats, on="Scenario")
 
-        fig.add_scatter(
-            x=df_plot["Stress PnL"],
-            y=df_plot["Scenario"],
-            mode="markers",
-            marker=dict(size=14, symbol="star", color="orange"),
-            name="Analysis portfolio"
-        )
+            fig = peer_analysis_chart(analysis_portfolio, df_plot)
 
-        st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True)
 
-        # =====================
-        # TABLE + EXCEL
-        # =====================
+            # =====================
+            # TABLE + EXCEL
+            # =====================
 
        
-        df_table = df_plot.rename(
-            columns={
-                "Stress PnL": "Analysis Stress PnL",
-                "peer_median": "Peer Median Stress PnL",
-                "q25": "Peer Q25 Stress PnL",
-                "q75": "Peer Q75 Stress PnL"
-            }
-        )[
-            [
-                "Scenario",
-                "Analysis Stress PnL",
-                "Peer Median Stress PnL",
-                "Peer Q25 Stress PnL",
-                "Peer Q75 Stress PnL"
+            df_table = df_plot.rename(
+                columns={
+                    "Stress PnL": "Analysis Stress PnL",
+                    "peer_median": "Peer Median Stress PnL",
+                    "q25": "Peer Q25 Stress PnL",
+                    "q75": "Peer Q75 Stress PnL"
+                }
+            )[
+                [
+                    "Scenario",
+                    "Analysis Stress PnL",
+                    "Peer Median Stress PnL",
+                    "Peer Q25 Stress PnL",
+                    "Peer Q75 Stress PnL"
+                ]
             ]
-        ]
-
-        st.markdown(
-            """
-            <div style="display: flex; align-items: center;">
-                <sub style="margin-right: 4px;">Note: the shaded areas</sub>
-                <div style="width: 20px; height: 14px; background-color: rgba(255,0,0,0.25); margin: 0 4px 0 0; border: 1px solid rgba(0,0,0,0.1);"></div>
-                <sub>represent the dispersion between the 25th and 75th percentile of the Peer median.</sub>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
 
-        
-        st.subheader("📋 Peer comparison table")
-        st.dataframe(df_table, use_container_width=True, hide_index=True)
+            st.markdown(
+                """
+                <div style="display: flex; align-items: center;">
+                    <sub style="margin-right: 4px;">Note: the shaded areas</sub>
+                    <div style="width: 20px; height: 14px; background-color: rgba(255,0,0,0.25); margin: 0 4px 0 0; border: 1px solid rgba(0,0,0,0.1);"></div>
+                    <sub>represent the dispersion between the 25th and 75th percentile of the Peer median.</sub>
+                </div>
+                """,
+                unsafe_allow_html=True
+            )
 
-        output_peer = BytesIO()
-        with pd.ExcelWriter(output_peer, engine="openpyxl") as writer:
-            df_table.to_excel(writer, sheet_name="Peer Comparison", index=False)
+        
+            st.subheader("📋 Peer comparison table")
+            st.dataframe(
+                df_table,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "Analysis Stress PnL": st.column_config.NumberColumn(format="%d")
+                }
+            )
 
-        st.download_button(
-            label="📥 Download peer comparison table as Excel",
-            data=output_peer.getvalue(),
-            file_name="peer_comparison_table.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+            st.download_button(
+                label="📥 Download peer comparison table as Excel",
+                data=build_xlsx(df_table, "Peer Comparison"),
+                file_name="peer_comparison_table.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
 
+peer_analysis(df_filt, visible_portfolios)
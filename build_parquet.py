@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+from loader import load_sheets_total, prepare_total, save_parquet, total_sheet_names
+
+FILE_PATH = Path("stress_test.xlsx")
+
+
+def build_parquet(path: Path) -> Path:
+    # Same typed, date-sorted layout the app writes for itself
+    df_total = prepare_total(load_sheets_total(path, total_sheet_names(path)))
+    return save_parquet(df_total, path)
+
+
+if __name__ == "__main__":
+    path = Path(sys.argv[1]) if len(sys.argv) > 1 else FILE_PATH
+    print(f"Written {build_parquet(path)}")
@@ -0,0 +1,70 @@
+import pandas as pd
+from operator import itemgetter
+from pathlib import Path
+from python_calamine import CalamineWorkbook
+
+TOTAL_COLUMNS = ["Risk Group", "Stress PnL", "Date", "Portfolio", "Scenario"]
+SHEET_COLUMNS = ["Sheet Portfolio", "Sheet Scenario"]
+
+
+def parquet_path(path: Path) -> Path:
+    return path.with_suffix(".parquet")
+
+
+def save_parquet(df_total: pd.DataFrame, path: Path) -> Path:
+    out = parquet_path(path)
+    df_total.to_parquet(out, compression="zstd", index=False)
+    return out
+
+
+def prepare_total(df_total: pd.DataFrame) -> pd.DataFrame:
+    # Filters then work on the integer category codes instead of strings
+    for col in ["Risk Group", "Portfolio", "Scenario"]:
+        df_total[col] = df_total[col].astype("category")
+
+    df_total["Stress PnL"] = df_total["Stress PnL"].astype("float32")
+
+    # datetime64 rather than datetime.date objects, so date lookups compare int64s
+    df_total["Date"] = pd.to_datetime(df_total["Date"]).dt.normalize()
+
+    # Keep rows ordered by date so a single day is a contiguous slice
+    return df_total.sort_values("Date", kind="stable", ignore_index=True)
+
+
+def total_sheet_names(path: Path) -> list[str]:
+    # Data sheets are named "<portfolio>_<scenario>"
+    return [s for s in CalamineWorkbook.from_path(path).sheet_names if "_" in s]
+
+
+def load_sheets_total(path: Path, sheets: list[str]) -> pd.DataFrame:
+    # One workbook handle per batch: a handle cannot be shared between threads.
+    # Opening is cheap; parsing each sheet is where the time goes
+    workbook = CalamineWorkbook.from_path(path)
+    total_rows = []
+
+    for sheet in sheets:
+        portfolio_sheet, scenario_sheet = sheet.split("_", 1)
+
+        # Stream the rows and keep only the "Total" ones, so the rest of the
+        # sheet never becomes a DataFrame (a sheet has one Total per date)
+        rows = workbook.get_sheet_by_name(sheet).iter_rows()
+        header = next(rows)
+        risk_group = header.index("Risk Group")
+
+        # Column positions differ between sheets, so resolve them per header
+        pick = itemgetter(*(header.index(c) for c in TOTAL_COLUMNS))
+        total_rows.extend(
+            pick(row) + (portfolio_sheet, scenario_sheet)
+            for row in rows
+            if row[risk_group] == "Total"
+        )
+
+    # One frame for the whole batch; calamine returns empty cells as "" rather
+    # than NaN, so blank them all here before any column is typed
+    df_total = pd.DataFrame(total_rows, columns=TOTAL_COLUMNS + SHEET_COLUMNS).replace("", None)
+
+    # Sheet-name fallbacks applied in a single pass instead of once per sheet
+    for col, sheet_col in zip(["Portfolio", "Scenario"], SHEET_COLUMNS):
+        df_total[col] = df_total[col].fillna(df_total.pop(sheet_col))
+
+    return df_total